@@ -26,10 +26,10 @@
 // Default: Markdown is enabled iff input file extension is ".bs" (case-insensitive).
 
 use clap::{ArgAction, Parser};
-use memchr::{memchr, memrchr};
+use memchr::{memchr, memchr2, memchr3, memchr_iter, memmem, memrchr};
 use std::fs;
-use std::io;
-use std::path::PathBuf;
+use std::io::{self, Write};
+use std::path::{Path, PathBuf};
 
 /// CLI flags
 #[derive(Parser)]
@@ -54,13 +54,12 @@ fn main() -> io::Result<()> {
     let cli = Cli::parse();
 
     let src = fs::read(&cli.input)?;
-    let mut out = Vec::with_capacity(src.len() + src.len() / 20 + 2048);
 
     // Default: enable markdown if input ends with ".bs"
     let default_md = cli
         .input
         .extension()
-        .map_or(false, |e| e.to_string_lossy().eq_ignore_ascii_case("bs"));
+        .is_some_and(|e| e.to_string_lossy().eq_ignore_ascii_case("bs"));
 
     // Precedence: explicit flags override default; --no-markdown wins if both are present.
     let use_markdown = if cli.no_markdown {
@@ -71,62 +70,133 @@ fn main() -> io::Result<()> {
         default_md
     };
 
-    transform(&src, &mut out, use_markdown);
+    // Markdown reflow works on `str`; reject bad input before any output is opened.
+    if use_markdown {
+        if let Err(e) = std::str::from_utf8(&src) {
+            return Err(io::Error::new(io::ErrorKind::InvalidData, e));
+        }
+    }
 
-    let out_path = cli.output.as_ref().unwrap_or(&cli.input);
-    fs::write(out_path, out)?;
+    match cli.output.as_ref().filter(|o| !is_same_file(o, &cli.input)) {
+        Some(out_path) => {
+            // Separate output file: stream into a sibling temp file as the
+            // transform goes, and only replace the target once it succeeded.
+            write_via_temp(out_path, |file| transform(&src, file, use_markdown))?;
+        }
+        None => {
+            // In place: leave the input untouched until the whole result is ready.
+            // Output is rarely longer than the input, so this is one allocation.
+            let mut out = Vec::with_capacity(src.len() + src.len() / 20 + 2048);
+            transform_into(&src, &mut out, use_markdown, None)?;
+            fs::write(cli.output.as_ref().unwrap_or(&cli.input), out)?;
+        }
+    }
     Ok(())
 }
 
-/* =============================== Core sets =============================== */
+/// Write `path` through a temp file in the same directory that is renamed over
+/// it on success, so a failed run leaves an existing file untouched. Anything
+/// that is not a regular file (a FIFO, /dev/stdout, a dangling symlink), or a
+/// directory we cannot create the temp file in, is opened and written directly.
+fn write_via_temp(path: &Path, write: impl FnOnce(&mut fs::File) -> io::Result<()>) -> io::Result<()> {
+    let target = match fs::canonicalize(path) {
+        Ok(target) if fs::metadata(&target).is_ok_and(|m| m.is_file()) => target,
+        Err(e) if e.kind() == io::ErrorKind::NotFound && fs::symlink_metadata(path).is_err() => path.to_path_buf(),
+        _ => return write(&mut fs::File::create(path)?),
+    };
+    let mut tmp_name = target.file_name().unwrap_or_default().to_os_string();
+    tmp_name.push(format!(".{}.tmp", std::process::id()));
+    let tmp = target.with_file_name(tmp_name);
 
-fn is_inline(name: &[u8]) -> bool {
-    matches_ignore_ascii_case(
-        name,
-        &[
-            b"a", b"abbr", b"b", b"bdi", b"bdo", b"cite", b"code", b"data", b"del", b"dfn", b"em",
-            b"i", b"ins", b"kbd", b"mark", b"q", b"s", b"samp", b"small", b"span", b"strong",
-            b"sub", b"sup", b"time", b"u", b"var", b"ref",
-        ],
-    )
+    let Ok(mut file) = fs::File::create(&tmp) else {
+        return write(&mut fs::File::create(path)?);
+    };
+    let result = (|| {
+        write(&mut file)?;
+        file.sync_all()?;
+        if let Ok(meta) = fs::metadata(&target) {
+            file.set_permissions(meta.permissions())?;
+        }
+        fs::rename(&tmp, &target)
+    })();
+    if result.is_err() {
+        let _ = fs::remove_file(&tmp);
+    }
+    result
 }
 
-fn is_void(name: &[u8]) -> bool {
-    matches_ignore_ascii_case(
-        name,
-        &[
-            b"area", b"base", b"br", b"col", b"embed", b"hr", b"img", b"input", b"link", b"meta",
-            b"param", b"source", b"track", b"wbr",
-        ],
-    )
+fn is_same_file(a: &Path, b: &Path) -> bool {
+    match (fs::canonicalize(a), fs::canonicalize(b)) {
+        (Ok(a), Ok(b)) => a == b,
+        _ => false,
+    }
 }
 
-fn is_raw_text(name: &[u8]) -> bool {
-    matches_ignore_ascii_case(
-        name,
-        &[b"pre", b"textarea", b"script", b"style", b"xmp", b"wpt"],
-    )
+/* =============================== Core sets =============================== */
+
+const INLINE: u8 = 1 << 0;
+const VOID: u8 = 1 << 1;
+const RAW_TEXT: u8 = 1 << 2;
+const STRUCTURAL: u8 = 1 << 3;
+
+/// All set memberships of a tag name in one lookup (case-insensitive).
+fn tag_category(name: &[u8]) -> u8 {
+    // Every known name fits; anything longer belongs to no set.
+    let mut buf = [0u8; 16];
+    if name.len() > buf.len() {
+        return 0;
+    }
+    let lower = &mut buf[..name.len()];
+    lower.copy_from_slice(name);
+    lower.make_ascii_lowercase();
+
+    match &*lower {
+        b"a" | b"abbr" | b"b" | b"bdi" | b"bdo" | b"cite" | b"code" | b"data" | b"del" | b"dfn"
+        | b"em" | b"i" | b"ins" | b"kbd" | b"mark" | b"q" | b"s" | b"samp" | b"small"
+        | b"span" | b"strong" | b"sub" | b"sup" | b"time" | b"u" | b"var" | b"ref" => INLINE,
+
+        b"area" | b"base" | b"br" | b"col" | b"embed" | b"img" | b"input" | b"link" | b"meta"
+        | b"param" | b"source" | b"track" | b"wbr" => VOID,
+        b"hr" => VOID | STRUCTURAL,
+
+        b"textarea" | b"script" | b"style" | b"xmp" | b"wpt" => RAW_TEXT,
+        b"pre" => RAW_TEXT | STRUCTURAL,
+
+        b"address" | b"article" | b"aside" | b"blockquote" | b"details" | b"dialog" | b"div"
+        | b"dl" | b"dt" | b"dd" | b"fieldset" | b"figcaption" | b"figure" | b"footer"
+        | b"form" | b"h1" | b"h2" | b"h3" | b"h4" | b"h5" | b"h6" | b"header" | b"hgroup"
+        | b"main" | b"menu" | b"nav" | b"ol" | b"p" | b"search" | b"section" | b"table"
+        | b"thead" | b"tbody" | b"tfoot" | b"tr" | b"td" | b"th" | b"caption" | b"colgroup"
+        | b"ul" | b"li" | b"optgroup" | b"option" | b"ruby" | b"rt" | b"rp"
+        | b"foreignobject" => STRUCTURAL,
+
+        _ => 0,
+    }
 }
 
 fn is_structural(name: &[u8]) -> bool {
-    matches_ignore_ascii_case(
-        name,
-        &[
-            b"address", b"article", b"aside", b"blockquote", b"details", b"dialog", b"div",
-            b"dl", b"dt", b"dd", b"fieldset", b"figcaption", b"figure", b"footer", b"form", b"h1",
-            b"h2", b"h3", b"h4", b"h5", b"h6", b"header", b"hgroup", b"hr", b"main", b"menu",
-            b"nav", b"ol", b"p", b"pre", b"search", b"section", b"table", b"thead", b"tbody",
-            b"tfoot", b"tr", b"td", b"th", b"caption", b"colgroup", b"ul", b"li", b"optgroup",
-            b"option", b"ruby", b"rt", b"rp", b"foreignobject",
-        ],
-    )
+    tag_category(name) & STRUCTURAL != 0
 }
 
 /* ============================ Utility predicates ========================= */
 
+/// ASCII alphanumerics plus '-', '_' and ':', indexed by byte value.
+const NAME_TABLE: [bool; 256] = {
+    let mut t = [false; 256];
+    let mut b = 0;
+    while b < 256 {
+        t[b] = (b as u8).is_ascii_alphanumeric();
+        b += 1;
+    }
+    t[b'-' as usize] = true;
+    t[b'_' as usize] = true;
+    t[b':' as usize] = true;
+    t
+};
+
 #[inline]
 fn is_name_char(b: u8) -> bool {
-    b.is_ascii_alphanumeric() || b == b'-' || b == b'_' || b == b':'
+    NAME_TABLE[b as usize]
 }
 
 #[inline]
@@ -134,30 +204,45 @@ fn is_space_tab(b: u8) -> bool {
     b == b' ' || b == b'\t'
 }
 
+/// Space, tab, LF and CR, indexed by byte value.
+const WS_TABLE: [bool; 256] = {
+    let mut t = [false; 256];
+    t[b' ' as usize] = true;
+    t[b'\t' as usize] = true;
+    t[b'\n' as usize] = true;
+    t[b'\r' as usize] = true;
+    t
+};
+
 #[inline]
 fn is_ws(b: u8) -> bool {
-    b == b' ' || b == b'\t' || b == b'\n' || b == b'\r'
+    WS_TABLE[b as usize]
 }
 
 fn matches_ignore_ascii_case(name: &[u8], set: &[&[u8]]) -> bool {
     set.iter().any(|&s| name.eq_ignore_ascii_case(s))
 }
 
-fn trim_spaces(buf: &mut Vec<u8>) {
-    let mut start = 0usize;
-    while start < buf.len() && buf[start] == b' ' {
-        start += 1;
-    }
-    let mut end = buf.len();
-    while end > start && buf[end - 1] == b' ' {
-        end -= 1;
+/* ============================== Line index ============================== */
+
+/// Sorted positions of every '\n' in the document, so that "start of the line
+/// containing `pos`" is a binary search instead of a backward scan.
+struct LineIndex {
+    newlines: Vec<usize>,
+}
+
+impl LineIndex {
+    fn new(src: &[u8]) -> Self {
+        LineIndex {
+            newlines: memchr_iter(b'\n', src).collect(),
+        }
     }
-    if start == 0 && end == buf.len() {
-        return;
+
+    /// Index just past the last '\n' before `pos` (0 on the first line).
+    fn line_start(&self, pos: usize) -> usize {
+        let k = self.newlines.partition_point(|&nl| nl < pos);
+        if k == 0 { 0 } else { self.newlines[k - 1] + 1 }
     }
-    let mut tmp = Vec::with_capacity(end - start);
-    tmp.extend_from_slice(&buf[start..end]);
-    *buf = tmp;
 }
 
 /* =============================== Tag parsing ============================= */
@@ -165,27 +250,24 @@ fn trim_spaces(buf: &mut Vec<u8>) {
 #[derive(Clone, Copy, Debug)]
 struct TagInfo<'a> {
     name: &'a [u8],
+    /// Index just past `name` within the tag; attribute scans resume here.
+    name_end: usize,
     is_end: bool,
     self_closing: bool,
 }
 
 /// Find the '>' for a tag starting at `i` (s[i] == '<'), being quote-aware.
 fn find_tag_end(s: &[u8], mut i: usize) -> Option<usize> {
-    let n = s.len();
     i += 1;
-    let mut quote: u8 = 0;
-    while i < n {
-        let b = s[i];
-        if quote != 0 {
-            if b == quote {
-                quote = 0;
-            }
-        } else if b == b'"' || b == b'\'' {
-            quote = b;
-        } else if b == b'>' {
-            return Some(i);
+    // Jump between the only bytes that matter: quotes and '>'.
+    while let Some(p) = memchr3(b'>', b'"', b'\'', &s[i..]) {
+        let b = s[i + p];
+        if b == b'>' {
+            return Some(i + p);
         }
-        i += 1;
+        // Skip the quoted run; an unterminated quote hides every later '>'.
+        let close = memchr(b, &s[i + p + 1..])?;
+        i += p + 1 + close + 1;
     }
     None
 }
@@ -218,6 +300,7 @@ fn parse_tag_info<'a>(tag: &'a [u8]) -> TagInfo<'a> {
 
     TagInfo {
         name,
+        name_end: i,
         is_end,
         self_closing,
     }
@@ -225,14 +308,29 @@ fn parse_tag_info<'a>(tag: &'a [u8]) -> TagInfo<'a> {
 
 /* ====================== data-noreformat attribute scan =================== */
 
-fn tag_has_noreformat_attr(tag: &[u8]) -> bool {
-    // Robust attribute scanner: [name] ( '=' [value] )?
-    let len = tag.len();
-    if len < 2 {
+fn tag_has_noreformat_attr(tag: &[u8], ti: &TagInfo) -> bool {
+    // Cheap reject: the attribute cannot be present unless its name appears
+    // somewhere in the tag, so look for "data-noreformat" around each '-'.
+    let mentions_attr = memchr_iter(b'-', tag).any(|p| {
+        p >= 4
+            && tag[p - 4..p].eq_ignore_ascii_case(b"data")
+            && tag.get(p + 1..p + 11).is_some_and(|s| s.eq_ignore_ascii_case(b"noreformat"))
+    });
+    if !mentions_attr {
         return false;
     }
-    let mut i = 1usize;
+    if ti.name.is_empty() {
+        return scan_attrs_for_noreformat(tag, 1);
+    }
+    // The scanner treats the element name like any other attribute name, and
+    // parse_tag_info has already read it: resume right after it.
+    ti.name.eq_ignore_ascii_case(b"data-noreformat")
+        || scan_attrs_for_noreformat(tag, skip_attr_value(tag, ti.name_end))
+}
 
+/// Robust attribute scanner: [name] ( '=' [value] )?, starting at `i`.
+fn scan_attrs_for_noreformat(tag: &[u8], mut i: usize) -> bool {
+    let len = tag.len();
     while i < len && tag[i] != b'>' {
         // skip whitespace and slashes
         while i < len && (is_ws(tag[i]) || tag[i] == b'/') {
@@ -258,42 +356,47 @@ fn tag_has_noreformat_attr(tag: &[u8]) -> bool {
             return true;
         }
 
+        // loop continues to parse next attribute
+        i = skip_attr_value(tag, i);
+    }
+    false
+}
+
+/// Skip an optional `= value` following an attribute name ending at `i`.
+fn skip_attr_value(tag: &[u8], mut i: usize) -> usize {
+    let len = tag.len();
+    // skip whitespace
+    while i < len && is_ws(tag[i]) {
+        i += 1;
+    }
+    if i < len && tag[i] == b'=' {
+        i += 1;
         // skip whitespace
         while i < len && is_ws(tag[i]) {
             i += 1;
         }
+        if i >= len || tag[i] == b'>' {
+            return i;
+        }
 
-        // optional "= value"
-        if i < len && tag[i] == b'=' {
+        // quoted value
+        if tag[i] == b'"' || tag[i] == b'\'' {
+            let q = tag[i];
             i += 1;
-            // skip whitespace
-            while i < len && is_ws(tag[i]) {
+            while i < len && tag[i] != q {
                 i += 1;
             }
-            if i >= len || tag[i] == b'>' {
-                break;
+            if i < len && tag[i] == q {
+                i += 1;
             }
-
-            // quoted value
-            if tag[i] == b'"' || tag[i] == b'\'' {
-                let q = tag[i];
+        } else {
+            // unquoted value
+            while i < len && !is_ws(tag[i]) && tag[i] != b'>' {
                 i += 1;
-                while i < len && tag[i] != q {
-                    i += 1;
-                }
-                if i < len && tag[i] == q {
-                    i += 1;
-                }
-            } else {
-                // unquoted value
-                while i < len && !is_ws(tag[i]) && tag[i] != b'>' {
-                    i += 1;
-                }
             }
         }
-        // loop continues to parse next attribute
     }
-    false
+    i
 }
 
 /* ======================== Inside-tag normalization ====================== */
@@ -305,59 +408,65 @@ fn normalize_inside_tag(tag: &[u8], out: &mut Vec<u8>) {
     }
     let inner = &tag[1..tag.len() - 1];
 
-    let mut buf: Vec<u8> = Vec::with_capacity(inner.len());
+    // Most tags (`<td>`, `</p>`, `<a href="x">`) are already normalized.
+    if is_normalized_tag_inner(inner) {
+        out.extend_from_slice(tag);
+        return;
+    }
+
+    // Normalized bytes are written straight into `out`; `start` marks where the
+    // inner part begins so that leading/trailing spaces can be trimmed in place.
+    // Bytes that pass through unchanged are not copied one by one: `seg` is the
+    // start of the pending unchanged span, flushed only at whitespace events.
+    out.push(b'<');
+    let start = out.len();
     let mut i = 0usize;
+    let mut seg = 0usize;
     let n = inner.len();
     let mut quote: u8 = 0;
 
-    let push_space_once = |buf: &mut Vec<u8>| {
-        if !buf.last().map(|b| *b == b' ').unwrap_or(false) {
-            buf.push(b' ');
+    // A space at the very start would be trimmed anyway, so never emit it.
+    let push_space_once = |out: &mut Vec<u8>| {
+        if out.len() > start && out.last() != Some(&b' ') {
+            out.push(b' ');
         }
     };
 
     while i < n {
-        let b = inner[i];
         if quote != 0 {
-            if b == quote {
-                buf.push(b);
+            // Inside quotes only newline-including whitespace runs change, so jump
+            // to whichever comes first: the closing quote or the next LF.
+            let hit = memchr2(quote, b'\n', &inner[i..]).map_or(n, |p| i + p);
+            if hit == n || inner[hit] == quote {
                 quote = 0;
-                i += 1;
-            } else if b == b'\n' || b == b'\r' || b == b' ' || b == b'\t' {
-                let mut j = i;
-                let mut saw_nl = false;
-                while j < n {
-                    let c = inner[j];
-                    if c == b'\n' || c == b'\r' || c == b' ' || c == b'\t' {
-                        if c == b'\n' {
-                            saw_nl = true;
-                        }
-                        j += 1;
-                    } else {
-                        break;
-                    }
-                }
-                if saw_nl {
-                    push_space_once(&mut buf);
-                } else {
-                    buf.extend_from_slice(&inner[i..j]);
-                }
-                i = j;
-            } else {
-                buf.push(b);
-                i += 1;
+                i = hit + 1;
+                continue;
+            }
+            let lf = hit;
+            let mut run_start = lf;
+            while run_start > i && is_ws(inner[run_start - 1]) {
+                run_start -= 1;
             }
+            out.extend_from_slice(&inner[seg..run_start]);
+            let mut j = lf + 1;
+            while j < n && is_ws(inner[j]) {
+                j += 1;
+            }
+            push_space_once(out);
+            i = j;
+            seg = j;
             continue;
         }
 
+        let b = inner[i];
         if b == b'"' || b == b'\'' {
             quote = b;
-            buf.push(b);
             i += 1;
             continue;
         }
 
         if is_ws(b) {
+            out.extend_from_slice(&inner[seg..i]);
             let mut j = i;
             let mut saw_nl = false;
             while j < n && is_ws(inner[j]) {
@@ -366,65 +475,73 @@ fn normalize_inside_tag(tag: &[u8], out: &mut Vec<u8>) {
                 }
                 j += 1;
             }
-            // Check neighbors around the run (outside quotes)
-            let mut p = i;
-            while p > 0 && is_ws(inner[p - 1]) {
-                p -= 1;
-            }
-            let left = if p > 0 { inner[p - 1] } else { 0 };
-            let mut q = j;
-            while q < n && is_ws(inner[q]) {
-                q += 1;
-            }
-            let right = if q < n { inner[q] } else { 0 };
+            // Outside quotes the run is always maximal, so its neighbors are
+            // simply the bytes on either side of it.
+            let left = if i > 0 { inner[i - 1] } else { 0 };
+            let right = if j < n { inner[j] } else { 0 };
 
             if saw_nl && (left == b'=' || right == b'=') {
                 // newline-run touching '=' → no space
             } else {
-                push_space_once(&mut buf);
+                push_space_once(out);
             }
             i = j;
+            seg = j;
             continue;
         }
 
-        buf.push(b);
+        // Skip the whole run of ordinary bytes up to the next whitespace or quote.
         i += 1;
+        while i < n && !is_ws(inner[i]) && inner[i] != b'"' && inner[i] != b'\'' {
+            i += 1;
+        }
     }
+    out.extend_from_slice(&inner[seg..n]);
 
-    trim_spaces(&mut buf);
-
-    out.push(b'<');
-    out.extend_from_slice(&buf);
+    while out.len() > start && out.last() == Some(&b' ') {
+        out.pop();
+    }
     out.push(b'>');
 }
 
+/// True if `inner` would come out of normalize_inside_tag unchanged: its only
+/// whitespace is single spaces, none of them at either end.
+fn is_normalized_tag_inner(inner: &[u8]) -> bool {
+    if inner.first() == Some(&b' ') || inner.last() == Some(&b' ') {
+        return false;
+    }
+    let mut prev_space = false;
+    for &b in inner {
+        match b {
+            b' ' if prev_space => return false,
+            b' ' => prev_space = true,
+            b'\t' | b'\n' | b'\r' => return false,
+            _ => prev_space = false,
+        }
+    }
+    true
+}
+
 /* ============================== Comments ================================ */
 
 /// Return (end_index_of_dash_in_terminator, is_standalone). If unterminated, end_index = usize::MAX.
 fn scan_comment(s: &[u8], i: usize) -> (usize, bool) {
     // Assumes s[i..].starts_with("<!--")
-    let mut k = i + 4;
-    while let Some(p) = memchr(b'-', &s[k..]) {
-        let j = k + p;
-        if j + 2 < s.len() && s[j + 1] == b'-' && s[j + 2] == b'>' {
-            // standalone if only spaces/tabs since line start AND next char after '-->' is '\n'
-            let line_start = memrchr(b'\n', &s[..i]).map(|x| x + 1).unwrap_or(0);
-            let mut only_ws = true;
-            for &c in &s[line_start..i] {
-                if !(c == b' ' || c == b'\t') {
-                    only_ws = false;
-                    break;
-                }
-            }
-            let next_is_lf = if j + 3 < s.len() { s[j + 3] == b'\n' } else { false };
-            return (j, only_ws && next_is_lf);
-        }
-        k = j + 1;
-        if k >= s.len() {
-            break;
-        }
+    let Some(p) = memmem::find(&s[i + 4..], b"-->") else {
+        return (usize::MAX, false);
+    };
+    let j = i + 4 + p;
+    // standalone if only spaces/tabs since line start AND next char after '-->' is '\n'
+    let next_is_lf = if j + 3 < s.len() { s[j + 3] == b'\n' } else { false };
+    if !next_is_lf {
+        return (j, false);
     }
-    (usize::MAX, false)
+    // Walk back over the indentation only, never the whole line.
+    let mut k = i;
+    while k > 0 && is_space_tab(s[k - 1]) {
+        k -= 1;
+    }
+    (j, k == 0 || s[k - 1] == b'\n')
 }
 
 fn reflow_inline_comment(comment: &[u8], out: &mut Vec<u8>) {
@@ -433,26 +550,9 @@ fn reflow_inline_comment(comment: &[u8], out: &mut Vec<u8>) {
         out.extend_from_slice(comment);
         return;
     }
-    let inner = &comment[4..comment.len() - 3];
+    // Same collapsing rule as plain text: newline + adjoining ws → one space.
     out.extend_from_slice(b"<!--");
-    let mut i = 0usize;
-    let n = inner.len();
-    while i < n {
-        let b = inner[i];
-        if b == b'\n' {
-            // collapse newline + adjoining ws to a single space
-            if !out.last().map(|b| *b == b' ').unwrap_or(false) {
-                out.push(b' ');
-            }
-            i += 1;
-            while i < n && (inner[i] == b' ' || inner[i] == b'\t' || inner[i] == b'\n') {
-                i += 1;
-            }
-        } else {
-            out.push(b);
-            i += 1;
-        }
-    }
+    reflow_plain_text(&comment[4..comment.len() - 3], out);
     out.extend_from_slice(b"-->");
 }
 
@@ -464,20 +564,30 @@ struct Fence {
     min: usize // min count
 }
 
+/// Whether `b`, the first non-blank byte of a line, can begin any of the block
+/// constructs below (fence, list item, dt/dd, heading, quote, hr, setext).
+#[inline]
+fn may_start_block(b: u8) -> bool {
+    matches!(b, b'`' | b'~' | b'*' | b'-' | b'_' | b'=' | b'#' | b'>' | b':' | b'0'..=b'9')
+}
+
+// Both checks only accept ASCII, so they work on bytes: any byte of a multi-byte
+// UTF-8 sequence is >= 0x80 and rejects the line like the char would.
+
 fn is_hr_line_stripped(s: &str) -> bool {
-    let mut c = '\0';
+    let mut c = 0u8;
     let mut count = 0usize;
-    for ch in s.chars() {
-        if ch == ' ' || ch == '\t' { continue; }
-        if c == '\0' {
-            if ch == '*' || ch == '-' || ch == '_' {
-                c = ch;
+    for &b in s.as_bytes() {
+        if b == b' ' || b == b'\t' { continue; }
+        if c == 0 {
+            if b == b'*' || b == b'-' || b == b'_' {
+                c = b;
                 count = 1;
             } else {
                 return false;
             }
         } else {
-            if ch != c { return false; }
+            if b != c { return false; }
             count += 1;
         }
     }
@@ -485,17 +595,18 @@ fn is_hr_line_stripped(s: &str) -> bool {
 }
 
 fn is_setext_underline_stripped(s: &str) -> bool {
-    let mut c = '\0';
-    for ch in s.chars() {
-        if ch == ' ' || ch == '\t' { continue; }
-        if ch == '-' || ch == '=' {
-            if c == '\0' { c = ch; }
-            else if c != ch { return false; }
+    let mut c = 0u8;
+    let mut count = 0usize;
+    for &b in s.as_bytes() {
+        if b == b' ' || b == b'\t' { continue; }
+        if b == b'-' || b == b'=' {
+            if c == 0 { c = b; }
+            else if c != b { return false; }
+            count += 1;
         } else {
             return false;
         }
     }
-    let count = s.chars().filter(|&ch| ch == '-' || ch == '=').count();
     count >= 2
 }
 
@@ -540,6 +651,30 @@ fn starts_with_ol(line: &str) -> Option<(String, String)> {
     Some((prefix, first))
 }
 
+/// True if `line` opens any block construct (fence, ATX heading, list item,
+/// dt/dd, quote, hr or setext underline). `stripped` is `line.trim()`, non-empty.
+///
+/// The indentation is skipped once and only the classifiers that can match the
+/// marker byte found there are run.
+fn is_block_start(line: &str, stripped: &str) -> bool {
+    if !may_start_block(stripped.as_bytes()[0]) {
+        return false;
+    }
+    let bytes = line.as_bytes();
+    let mut i = 0usize;
+    while i < bytes.len() && (bytes[i] == b' ' || bytes[i] == b'\t') { i += 1; }
+    let marker_line = match bytes.get(i) {
+        Some(b'`' | b'~') => fence_open(line).is_some(),
+        Some(b'#') => is_atx_heading(line),
+        Some(b'*' | b'-') => starts_with_bullet(line).is_some(),
+        Some(b'0'..=b'9') => starts_with_ol(line).is_some(),
+        Some(b':') => parse_dt(line).is_some() || parse_dd(line).is_some(),
+        Some(b'>') => is_blockquote(line),
+        _ => false,
+    };
+    marker_line || is_hr_line_stripped(stripped) || is_setext_underline_stripped(stripped)
+}
+
 fn is_atx_heading(line: &str) -> bool {
     // ^\s*#{1,6}\s+
     let bytes = line.as_bytes();
@@ -653,11 +788,10 @@ fn body_begins_with_dt_or_dd_after_single_lf(body: &[u8]) -> bool {
 /// Return true if the **line containing `pos`** begins (after optional spaces/tabs)
 /// with `: ` or `:: ` — i.e., a DT/DD marker. This handles the case where `pos`
 /// points into the *same line* (e.g., at a `<` that follows the marker).
-fn line_at_pos_starts_with_dt_or_dd(src: &[u8], pos: usize) -> bool {
+fn line_at_pos_starts_with_dt_or_dd(src: &[u8], lines: &LineIndex, pos: usize) -> bool {
     let n = src.len();
     if pos > n { return false; }
-    let line_start = memrchr(b'\n', &src[..pos]).map(|x| x + 1).unwrap_or(0);
-    let mut i = line_start;
+    let mut i = lines.line_start(pos);
     while i < n && (src[i] == b' ' || src[i] == b'\t') { i += 1; }
     if i >= n { return false; }
     if src[i] != b':' { return false; }
@@ -683,187 +817,106 @@ fn leading_lf_indent_end_before_dt_or_dd(body: &[u8]) -> Option<usize> {
     Some(j)
 }
 
-fn reflow_markdown_text(text: &str) -> String {
+fn reflow_markdown_text(text: &str, out: &mut Vec<u8>) {
     if text.is_empty() {
-        return String::new();
+        return;
+    }
+
+    // A single line is either blank, a block construct, or a one-line paragraph
+    // that only loses its trailing blanks.
+    if memchr(b'\n', text.as_bytes()).is_none() {
+        let stripped = text.trim();
+        if stripped.is_empty() {
+            out.extend_from_slice(text.as_bytes());
+            return;
+        }
+        if !may_start_block(stripped.as_bytes()[0]) {
+            out.extend_from_slice(text.trim_end_matches([' ', '\t']).as_bytes());
+            return;
+        }
     }
 
-    let mut out = String::with_capacity(text.len());
-    let mut para_parts: Vec<String> = Vec::new();
+    let mut para_parts: Vec<&str> = Vec::new();
     let mut in_fence: Option<Fence> = None;
     let mut prev_nonblank_was_paragraph = false;
 
     let mut lines_iter = text.split_inclusive('\n').peekable();
 
-    let flush_para = |add_trailing_nl: bool, out: &mut String, para_parts: &mut Vec<String>| {
+    let flush_para = |add_trailing_nl: bool, out: &mut Vec<u8>, para_parts: &mut Vec<&str>| {
         if para_parts.is_empty() { return; }
         if para_parts.len() == 1 {
-            out.push_str(&para_parts[0]);
+            out.extend_from_slice(para_parts[0].as_bytes());
         } else {
             let first = para_parts[0].trim_end_matches([' ', '\t']);
-            out.push_str(first);
+            out.extend_from_slice(first.as_bytes());
             for s in para_parts.iter().skip(1) {
                 let s2 = s.trim_start_matches([' ', '\t']);
-                out.push(' ');
-                out.push_str(s2);
+                out.push(b' ');
+                out.extend_from_slice(s2.as_bytes());
             }
         }
-        if add_trailing_nl { out.push('\n'); }
+        if add_trailing_nl { out.push(b'\n'); }
         para_parts.clear();
     };
 
     while let Some(raw) = lines_iter.next() {
         let had_nl = raw.ends_with('\n');
         let line_no_nl = if had_nl { &raw[..raw.len()-1] } else { raw };
-        let line_stripped_ws = line_no_nl.trim();
 
+        // Inside a fence only the closing test applies; `f` was built once when
+        // the fence opened.
         if let Some(f) = in_fence {
             if fence_close(line_no_nl, f) {
-                flush_para(false, &mut out, &mut para_parts);
-                out.push_str(raw);
+                flush_para(false, out, &mut para_parts);
+                out.extend_from_slice(raw.as_bytes());
                 in_fence = None;
                 prev_nonblank_was_paragraph = false;
             } else {
-                out.push_str(raw);
+                out.extend_from_slice(raw.as_bytes());
             }
             continue;
         }
 
-        if line_stripped_ws.is_empty() {
-            flush_para(true, &mut out, &mut para_parts);
-            out.push_str(raw);
-            prev_nonblank_was_paragraph = false;
-            continue;
-        }
-
-        if let Some(f) = fence_open(line_no_nl) {
-            flush_para(false, &mut out, &mut para_parts);
-            in_fence = Some(f);
-            out.push_str(raw);
-            prev_nonblank_was_paragraph = false;
-            continue;
-        }
-
-        // Handle UL/OL/DT/DD first
-        if let Some((prefix, first_text)) = starts_with_bullet(line_no_nl) {
-            flush_para(true, &mut out, &mut para_parts);
-            let mut contents: Vec<String> = vec![first_text];
-            let mut last_had_nl = had_nl;
-
-            while let Some(peek) = lines_iter.peek() {
-                let nxt_raw = *peek;
-                let nxt_had_nl = nxt_raw.ends_with('\n');
-                let nxt = if nxt_had_nl { &nxt_raw[..nxt_raw.len()-1] } else { nxt_raw };
-                let nxt_stripped = nxt.trim();
-
-                if nxt_stripped.is_empty() { break; }
-                if fence_open(nxt).is_some()
-                    || is_atx_heading(nxt)
-                    || starts_with_bullet(nxt).is_some()
-                    || starts_with_ol(nxt).is_some()
-                    || parse_dt(nxt).is_some() || parse_dd(nxt).is_some()
-                    || is_blockquote(nxt)
-                    || is_hr_line_stripped(nxt_stripped)
-                    || is_setext_underline_stripped(nxt_stripped)
-                { break; }
-                contents.push(nxt.trim_start_matches([' ', '\t']).to_string());
-                last_had_nl = nxt_had_nl;
-                lines_iter.next();
-            }
+        let line_stripped_ws = line_no_nl.trim();
 
-            let mut joined = contents.remove(0).trim_end_matches([' ', '\t']).to_string();
-            for c in contents {
-                joined.push(' ');
-                joined.push_str(c.trim_start_matches([' ', '\t']));
-            }
-            out.push_str(&prefix);
-            out.push_str(&joined);
-            if last_had_nl { out.push('\n'); }
+        if line_stripped_ws.is_empty() {
+            flush_para(true, out, &mut para_parts);
+            out.extend_from_slice(raw.as_bytes());
             prev_nonblank_was_paragraph = false;
             continue;
         }
 
-        if let Some((prefix, first_text)) = starts_with_ol(line_no_nl) {
-            flush_para(true, &mut out, &mut para_parts);
-            let mut contents: Vec<String> = vec![first_text];
-            let mut last_had_nl = had_nl;
-
-            while let Some(peek) = lines_iter.peek() {
-                let nxt_raw = *peek;
-                let nxt_had_nl = nxt_raw.ends_with('\n');
-                let nxt = if nxt_had_nl { &nxt_raw[..nxt_raw.len()-1] } else { nxt_raw };
-                let nxt_stripped = nxt.trim();
-
-                if nxt_stripped.is_empty() { break; }
-                if fence_open(nxt).is_some()
-                    || is_atx_heading(nxt)
-                    || starts_with_bullet(nxt).is_some()
-                    || starts_with_ol(nxt).is_some()
-                    || parse_dt(nxt).is_some() || parse_dd(nxt).is_some()
-                    || is_blockquote(nxt)
-                    || is_hr_line_stripped(nxt_stripped)
-                    || is_setext_underline_stripped(nxt_stripped)
-                { break; }
-                contents.push(nxt.trim_start_matches([' ', '\t']).to_string());
-                last_had_nl = nxt_had_nl;
-                lines_iter.next();
-            }
-
-            let mut joined = contents.remove(0).trim_end_matches([' ', '\t']).to_string();
-            for c in contents {
-                joined.push(' ');
-                joined.push_str(c.trim_start_matches([' ', '\t']));
-            }
-            out.push_str(&prefix);
-            out.push_str(&joined);
-            if last_had_nl { out.push('\n'); }
-            prev_nonblank_was_paragraph = false;
+        // Ordinary prose line: no classifier can match, skip them all.
+        if !may_start_block(line_stripped_ws.as_bytes()[0]) {
+            para_parts.push(line_no_nl);
+            prev_nonblank_was_paragraph = true;
             continue;
         }
 
-        if let Some((prefix, first_text)) = parse_dt(line_no_nl) {
-            // Definition term
-            flush_para(true, &mut out, &mut para_parts);
-            let mut contents: Vec<String> = vec![first_text];
-            let mut last_had_nl = had_nl;
+        // Each classifier only runs if it can match the byte after the
+        // indentation (as in is_block_start).
+        let marker = line_no_nl.bytes().find(|&b| b != b' ' && b != b'\t').unwrap_or(0);
 
-            while let Some(peek) = lines_iter.peek() {
-                let nxt_raw = *peek;
-                let nxt_had_nl = nxt_raw.ends_with('\n');
-                let nxt = if nxt_had_nl { &nxt_raw[..nxt_raw.len()-1] } else { nxt_raw };
-                let nxt_stripped = nxt.trim();
-
-                if nxt_stripped.is_empty() { break; }
-                if fence_open(nxt).is_some()
-                    || is_atx_heading(nxt)
-                    || starts_with_bullet(nxt).is_some()
-                    || starts_with_ol(nxt).is_some()
-                    || parse_dt(nxt).is_some() || parse_dd(nxt).is_some()
-                    || is_blockquote(nxt)
-                    || is_hr_line_stripped(nxt_stripped)
-                    || is_setext_underline_stripped(nxt_stripped)
-                { break; }
-                contents.push(nxt.trim_start_matches([' ', '\t']).to_string());
-                last_had_nl = nxt_had_nl;
-                lines_iter.next();
-            }
-
-            let mut joined = contents.remove(0).trim_end_matches([' ', '\t']).to_string();
-            for c in contents {
-                joined.push(' ');
-                joined.push_str(c.trim_start_matches([' ', '\t']));
-            }
-            out.push_str(&prefix);
-            out.push_str(&joined);
-            if last_had_nl { out.push('\n'); }
+        if let Some(f) = matches!(marker, b'`' | b'~').then(|| fence_open(line_no_nl)).flatten() {
+            flush_para(false, out, &mut para_parts);
+            in_fence = Some(f);
+            out.extend_from_slice(raw.as_bytes());
             prev_nonblank_was_paragraph = false;
             continue;
         }
 
-        if let Some((prefix, first_text)) = parse_dd(line_no_nl) {
-            // Definition description
-            flush_para(true, &mut out, &mut para_parts);
-            let mut contents: Vec<String> = vec![first_text];
+        // UL/OL/DT/DD items; only the parsers for this marker byte run.
+        let item = match marker {
+            b'*' | b'-' => starts_with_bullet(line_no_nl),
+            b'0'..=b'9' => starts_with_ol(line_no_nl),
+            b':' => parse_dt(line_no_nl).or_else(|| parse_dd(line_no_nl)),
+            _ => None,
+        };
+        if let Some((prefix, first_text)) = item {
+            flush_para(true, out, &mut para_parts);
+            // Emit the item directly; wrapped lines are appended as they are consumed.
+            out.extend_from_slice(prefix.as_bytes());
+            out.extend_from_slice(first_text.trim_end_matches([' ', '\t']).as_bytes());
             let mut last_had_nl = had_nl;
 
             while let Some(peek) = lines_iter.peek() {
@@ -873,112 +926,84 @@ fn reflow_markdown_text(text: &str) -> String {
                 let nxt_stripped = nxt.trim();
 
                 if nxt_stripped.is_empty() { break; }
-                if fence_open(nxt).is_some()
-                    || is_atx_heading(nxt)
-                    || starts_with_bullet(nxt).is_some()
-                    || starts_with_ol(nxt).is_some()
-                    || parse_dt(nxt).is_some() || parse_dd(nxt).is_some()
-                    || is_blockquote(nxt)
-                    || is_hr_line_stripped(nxt_stripped)
-                    || is_setext_underline_stripped(nxt_stripped)
-                { break; }
-                contents.push(nxt.trim_start_matches([' ', '\t']).to_string());
+                if is_block_start(nxt, nxt_stripped) { break; }
+                out.push(b' ');
+                out.extend_from_slice(nxt.trim_start_matches([' ', '\t']).as_bytes());
                 last_had_nl = nxt_had_nl;
                 lines_iter.next();
             }
 
-            let mut joined = contents.remove(0).trim_end_matches([' ', '\t']).to_string();
-            for c in contents {
-                joined.push(' ');
-                joined.push_str(c.trim_start_matches([' ', '\t']));
-            }
-            out.push_str(&prefix);
-            out.push_str(&joined);
-            if last_had_nl { out.push('\n'); }
+            if last_had_nl { out.push(b'\n'); }
             prev_nonblank_was_paragraph = false;
             continue;
         }
 
         // Generic structural lines
         let is_structural_line =
-            is_atx_heading(line_no_nl) ||
-            is_blockquote(line_no_nl) ||
+            (marker == b'#' && is_atx_heading(line_no_nl)) ||
+            (marker == b'>' && is_blockquote(line_no_nl)) ||
             is_hr_line_stripped(line_stripped_ws) ||
             (is_setext_underline_stripped(line_stripped_ws) && prev_nonblank_was_paragraph);
 
         if is_structural_line {
-            flush_para(true, &mut out, &mut para_parts);
-            out.push_str(raw);
+            flush_para(true, out, &mut para_parts);
+            out.extend_from_slice(raw.as_bytes());
             prev_nonblank_was_paragraph = false;
             continue;
         }
 
         // Regular paragraph line
-        para_parts.push(line_no_nl.to_string());
+        para_parts.push(line_no_nl);
         prev_nonblank_was_paragraph = true;
     }
 
     // flush at end
     if !para_parts.is_empty() {
-        let mut buf = String::new();
         let first = para_parts[0].trim_end_matches([' ', '\t']);
-        buf.push_str(first);
+        out.extend_from_slice(first.as_bytes());
         for s in para_parts.iter().skip(1) {
-            buf.push(' ');
-            buf.push_str(s.trim_start_matches([' ', '\t']));
+            out.push(b' ');
+            out.extend_from_slice(s.trim_start_matches([' ', '\t']).as_bytes());
         }
-        out.push_str(&buf);
     }
-
-    out
 }
 
-// UTF-8 safe plain-text reflow: collapse newline-including runs to a single space.
-fn reflow_plain_text(text: &str) -> String {
-    if text.is_empty() {
-        return String::new();
-    }
-    let bytes = text.as_bytes();
-    let mut out = String::with_capacity(text.len());
+// Plain-text reflow: collapse newline-including runs to a single space. Only
+// ASCII bytes are inspected, so it works on the UTF-8 bytes directly.
+fn reflow_plain_text(bytes: &[u8], out: &mut Vec<u8>) {
+    let start = out.len();
     let mut i = 0usize;
-    let mut seg_start = 0usize;
 
-    while i < bytes.len() {
-        if bytes[i] == b'\n' {
-            if seg_start < i {
-                out.push_str(&text[seg_start..i]); // safe: char boundary
-            }
-            if !out.ends_with(' ') {
-                out.push(' ');
-            }
-            i += 1;
-            while i < bytes.len() && (bytes[i] == b'\n' || bytes[i] == b' ' || bytes[i] == b'\t') {
-                i += 1;
-            }
-            seg_start = i;
-        } else {
+    while let Some(p) = memchr(b'\n', &bytes[i..]) {
+        let nl = i + p;
+        out.extend_from_slice(&bytes[i..nl]);
+        if out.len() == start || out.last() != Some(&b' ') {
+            out.push(b' ');
+        }
+        i = nl + 1;
+        while i < bytes.len() && (bytes[i] == b'\n' || bytes[i] == b' ' || bytes[i] == b'\t') {
             i += 1;
         }
     }
-    if seg_start < bytes.len() {
-        out.push_str(&text[seg_start..]);
-    }
-    out
+    out.extend_from_slice(&bytes[i..]);
 }
 
-fn reflow_text(text: &str, use_markdown: bool) -> String {
+/// Reflow `text` and append the result to `out`. Only the markdown pass needs
+/// the text as `str`; main rejects invalid UTF-8 input in markdown mode, and
+/// chunks are cut at ASCII bytes, so the conversion cannot fail there.
+fn reflow_text(text: &[u8], use_markdown: bool, out: &mut Vec<u8>) {
     if use_markdown {
-        reflow_markdown_text(text)
+        reflow_markdown_text(std::str::from_utf8(text).unwrap(), out)
     } else {
-        reflow_plain_text(text)
+        reflow_plain_text(text, out)
     }
 }
 
 /* ==================== Structural boundary helper ======================== */
 
-fn prev_line_ends_with_structural_start(s: &[u8], mut boundary: usize) -> bool {
+fn prev_line_ends_with_structural_start(s: &[u8], lines: &LineIndex, mut boundary: usize) -> bool {
     loop {
-        let line_start = memrchr(b'\n', &s[..boundary]).map(|x| x + 1).unwrap_or(0);
+        let line_start = lines.line_start(boundary);
         if line_start >= boundary { return false; }
         // Trim trailing spaces/tabs
         let mut end = boundary;
@@ -1019,39 +1044,48 @@ fn trailing_lf_count_ignoring_spaces(chunk: &[u8]) -> usize {
     k
 }
 
+/// Drop trailing spaces/tabs, plus at most one LF and the spaces/tabs before it,
+/// from `buf[start..]` by truncating once instead of popping byte by byte.
+fn trim_trailing_soft_break(buf: &mut Vec<u8>, start: usize) {
+    let mut end = buf.len();
+    while end > start && is_space_tab(buf[end - 1]) { end -= 1; }
+    if end > start && buf[end - 1] == b'\n' {
+        end -= 1;
+        while end > start && is_space_tab(buf[end - 1]) { end -= 1; }
+    }
+    buf.truncate(end);
+}
+
 /* ============================ Raw-text copying ========================== */
 
 /// Copy bytes from `i` until the **matching** end tag `</name>` is found.
 /// Returns (new_index_after_end_tag, closed_found).
 fn copy_raw_text_until_end(src: &[u8], i: usize, name: &[u8], out: &mut Vec<u8>) -> (usize, bool) {
     let n = src.len();
-    let lower_name = name.to_ascii_lowercase();
-    let name_ref = lower_name.as_slice();
 
     let mut j = i;
     loop {
         if j >= n {
             return (n, false);
         }
-        let Some(pos) = memchr(b'<', &src[j..]).map(|off| j + off) else {
+        // Only "</" can end raw text; any other '<' is copied with the content.
+        let Some(pos) = memmem::find(&src[j..], b"</").map(|off| j + off) else {
             out.extend_from_slice(&src[j..]);
             return (n, false);
         };
         // emit text between j and pos verbatim
         out.extend_from_slice(&src[j..pos]);
 
-        // Not enough room for "</"
-        if pos + 2 >= n || src[pos + 1] != b'/' {
-            // literal '<'
-            out.push(b'<');
-            j = pos + 1;
-            continue;
+        // Nothing after "</": it is literal text
+        if pos + 2 >= n {
+            out.extend_from_slice(&src[pos..]);
+            return (n, false);
         }
 
         // Try to parse an end tag
         if let Some(end) = find_tag_end(src, pos) {
             let ti = parse_tag_info(&src[pos..=end]);
-            if ti.name.eq_ignore_ascii_case(name_ref) {
+            if ti.name.eq_ignore_ascii_case(name) {
                 normalize_inside_tag(&src[pos..=end], out);
                 return (end + 1, true);
             } else {
@@ -1068,36 +1102,70 @@ fn copy_raw_text_until_end(src: &[u8], i: usize, name: &[u8], out: &mut Vec<u8>)
 
 /* ========================== Text chunk handling ========================= */
 
-fn classify_ahead(src: &[u8], next_lt: usize) -> (bool, bool, Option<TagInfo<'_>>) {
+/// A token scanned by a text chunk's lookahead, with its tag already parsed.
+#[derive(Clone, Copy)]
+struct Lookahead<'a> {
+    token: Token,
+    tag: Option<TagInfo<'a>>,
+}
+
+/// Classify the token at `next_lt` (the '<' ending a text chunk). The scan is
+/// stored in `ahead` so the main loop can reuse it instead of scanning again.
+fn classify_ahead<'a>(src: &'a [u8], next_lt: usize, ahead: &mut Option<Lookahead<'a>>) -> (bool, bool, Option<TagInfo<'a>>) {
     if next_lt >= src.len() { return (false, false, None); }
-    if src[next_lt..].starts_with(b"<!--") {
-        let (j_end, standalone) = scan_comment(src, next_lt);
-        if j_end == usize::MAX { return (false, false, None); }
-        return (standalone, !standalone, None);
-    }
-    if src[next_lt] == b'<' {
-        if let Some(j) = find_tag_end(src, next_lt) {
-            let ti = parse_tag_info(&src[next_lt..=j]);
-            return (false, false, Some(ti));
-        }
+    let la = ahead.get_or_insert_with(|| {
+        let token = next_token(src, next_lt);
+        let tag = match token {
+            Token::Tag { end } => Some(parse_tag_info(&src[next_lt..=end])),
+            _ => None,
+        };
+        Lookahead { token, tag }
+    });
+    match la.token {
+        Token::Comment { standalone, .. } => (standalone, !standalone, None),
+        Token::Tag { .. } => (false, false, la.tag),
+        Token::Text { .. } | Token::Unterminated => (false, false, None),
     }
-    (false, false, None)
+}
+
+/// Where a text chunk sits in the document, for the rules that look around it.
+struct ChunkContext<'a> {
+    src: &'a [u8],
+    lines: &'a LineIndex,
+    /// Position of the chunk in `src`.
+    at_index_i: usize,
+    /// The '<' that ends the chunk, or `src.len()`.
+    next_lt: usize,
+    /// Set to the scan of the token at `next_lt` if the chunk needed it.
+    ahead: Option<Lookahead<'a>>,
 }
 
 fn reflow_text_chunk(
     chunk: &[u8],
-    src: &[u8],
-    next_lt: usize,
+    ctx: &mut ChunkContext,
     out: &mut Vec<u8>,
     use_markdown: bool,
     after_boundary: bool,
     after_br: bool,
-    at_index_i: usize,
 ) {
-    let (ahead_is_standalone_comment, ahead_is_inline_comment, ahead_tag) = classify_ahead(src, next_lt);
+    let (src, lines, next_lt, at_index_i) = (ctx.src, ctx.lines, ctx.next_lt, ctx.at_index_i);
+
+    // Single-line text without edge whitespace (`<b>word</b>`) reflows to itself
+    // unless markdown might read it as a block construct.
+    if memchr(b'\n', chunk).is_none() && !is_ws(chunk[0]) && !is_ws(chunk[chunk.len() - 1]) {
+        let first = chunk[0];
+        if !use_markdown || (first.is_ascii_graphic() && !may_start_block(first)) {
+            out.extend_from_slice(chunk);
+            return;
+        }
+    }
+
+    let (ahead_is_standalone_comment, ahead_is_inline_comment, ahead_tag) = classify_ahead(src, next_lt, &mut ctx.ahead);
+    let ahead_category = ahead_tag.map_or(0, |ti| tag_category(ti.name));
 
-    let chunk_is_ws_only = chunk.iter().all(|&b| is_ws(b));
-    if chunk_is_ws_only {
+    // Length of the leading whitespace; the whole chunk if it is blank.
+    let ws_prefix_len = chunk.iter().position(|&b| !is_ws(b)).unwrap_or(chunk.len());
+    if ws_prefix_len == chunk.len() {
         // If we just emitted a structural boundary (including a standalone comment)
         // or a <br>, preserve the whitespace verbatim. Standalone comments are
         // structural on BOTH sides, so the immediately following newline must stay.
@@ -1111,7 +1179,7 @@ fn reflow_text_chunk(
                 out.extend_from_slice(chunk);
             } else if ahead_is_inline_comment {
                 if has_single_lf(chunk) {
-                    if prev_line_ends_with_structural_start(src, next_lt) {
+                    if prev_line_ends_with_structural_start(src, lines, next_lt) {
                         out.extend_from_slice(chunk);
                     } else {
                         out.push(b' ');
@@ -1120,12 +1188,12 @@ fn reflow_text_chunk(
                     out.extend_from_slice(chunk);
                 }
             } else if let Some(ti) = ahead_tag {
-                let structural_ahead = is_structural(ti.name);
+                let structural_ahead = ahead_category & STRUCTURAL != 0;
                 if structural_ahead {
                     out.extend_from_slice(chunk);
-                } else if !ti.is_end && is_inline(ti.name) {
+                } else if !ti.is_end && ahead_category & INLINE != 0 {
                     if has_single_lf(chunk) {
-                        if prev_line_ends_with_structural_start(src, next_lt) {
+                        if prev_line_ends_with_structural_start(src, lines, next_lt) {
                             out.extend_from_slice(chunk);
                         } else {
                             out.push(b' ');
@@ -1146,20 +1214,12 @@ fn reflow_text_chunk(
     }
 
     // Non-whitespace chunk
-    let mut preserve_trailing_suffix = false;
-    if next_lt < src.len() {
-        if ahead_is_standalone_comment {
-            preserve_trailing_suffix = true;
-        } else if let Some(ti) = ahead_tag {
-            if is_structural(ti.name) {
-                preserve_trailing_suffix = true;
-            }
-        }
-    }
+    let mut preserve_trailing_suffix =
+        next_lt < src.len() && (ahead_is_standalone_comment || ahead_category & STRUCTURAL != 0);
 
     // If the line that contains `next_lt` (often a DT/DD line) begins with : or ::, keep suffix.
     let boundary_end = at_index_i + chunk.len();
-    if use_markdown && line_at_pos_starts_with_dt_or_dd(src, boundary_end) {
+    if use_markdown && line_at_pos_starts_with_dt_or_dd(src, lines, boundary_end) {
         preserve_trailing_suffix = true;
     }
 
@@ -1169,15 +1229,14 @@ fn reflow_text_chunk(
         // prefix: leading whitespace
         let mut left = 0usize;
         if preserve_leading_prefix {
-            while left < chunk.len() && is_ws(chunk[left]) { left += 1; }
+            left = ws_prefix_len;
             out.extend_from_slice(&chunk[..left]);
         }
         // suffix: ALL trailing whitespace (preserve exactly before structural/comment/DT/DD)
-        let mut idx = chunk.len();
-        while idx > left && is_ws(chunk[idx - 1]) {
-            idx -= 1;
-        }
-        let suffix_start = idx;
+        let suffix_start = chunk[left..]
+            .iter()
+            .rposition(|&b| !is_ws(b))
+            .map_or(left, |p| left + p + 1);
         let body = &chunk[left..suffix_start];
 
         if !body.is_empty() {
@@ -1187,53 +1246,44 @@ fn reflow_text_chunk(
                     // Emit "\n" + indentation
                     out.push(b'\n');
                     out.extend_from_slice(&body[1..indent_end]); // indentation
-                    let rest = std::str::from_utf8(&body[indent_end..]).unwrap();
-                    let reflowed = reflow_text(rest, use_markdown);
-                    out.extend_from_slice(reflowed.as_bytes());
+                    let rest = &body[indent_end..];
+                    reflow_text(rest, use_markdown, out);
                 } else if body.starts_with(b"\n") && (body.len() == 1 || body[1] != b'\n')
-                    && !prev_line_ends_with_structural_start(src, at_index_i)
                     && !after_br && !after_boundary
                     && !(use_markdown && body_begins_with_dt_or_dd_after_single_lf(body))
+                    && !prev_line_ends_with_structural_start(src, lines, at_index_i)
                 {
                     // Soft wrap single LF → space
                     let mut j = 1usize;
                     while j < body.len() && (body[j] == b' ' || body[j] == b'\t') { j += 1; }
-                    let rest = std::str::from_utf8(&body[j..]).unwrap();
-                    let mut body_str = String::with_capacity(1 + rest.len());
-                    body_str.push(' ');
-                    body_str.push_str(rest);
-                    let reflowed = reflow_text(&body_str, use_markdown);
-                    out.extend_from_slice(reflowed.as_bytes());
+                    let mut body_str = Vec::with_capacity(1 + body.len() - j);
+                    body_str.push(b' ');
+                    body_str.extend_from_slice(&body[j..]);
+                    reflow_text(&body_str, use_markdown, out);
                 } else {
-                    let body_str = std::str::from_utf8(body).unwrap();
-                    let reflowed = reflow_text(body_str, use_markdown);
-                    out.extend_from_slice(reflowed.as_bytes());
+                    reflow_text(body, use_markdown, out);
                 }
             } else {
                 // Plain text mode
                 if body.starts_with(b"\n") && (body.len() == 1 || body[1] != b'\n')
-                    && !prev_line_ends_with_structural_start(src, at_index_i)
                     && !after_br && !after_boundary
+                    && !prev_line_ends_with_structural_start(src, lines, at_index_i)
                 {
                     let mut j = 1usize;
                     while j < body.len() && (body[j] == b' ' || body[j] == b'\t') { j += 1; }
-                    let rest = std::str::from_utf8(&body[j..]).unwrap();
-                    let mut body_str = String::with_capacity(1 + rest.len());
-                    body_str.push(' ');
-                    body_str.push_str(rest);
-                    let reflowed = reflow_text(&body_str, use_markdown);
-                    out.extend_from_slice(reflowed.as_bytes());
+                    let mut body_str = Vec::with_capacity(1 + body.len() - j);
+                    body_str.push(b' ');
+                    body_str.extend_from_slice(&body[j..]);
+                    reflow_text(&body_str, use_markdown, out);
                 } else {
-                    let body_str = std::str::from_utf8(body).unwrap();
-                    let reflowed = reflow_text(body_str, use_markdown);
-                    out.extend_from_slice(reflowed.as_bytes());
+                    reflow_text(body, use_markdown, out);
                 }
             }
         }
 
         if preserve_trailing_suffix {
             out.extend_from_slice(&chunk[suffix_start..]); // preserve spaces/newlines before DT/DD/comment/structural
-        } else if (ahead_tag.map_or(false, |ti| !ti.is_end && is_inline(ti.name)) || ahead_is_inline_comment) && suffix_start < chunk.len() {
+        } else if (ahead_tag.is_some_and(|ti| !ti.is_end && ahead_category & INLINE != 0) || ahead_is_inline_comment) && suffix_start < chunk.len() {
             out.push(b' ');
         }
         return;
@@ -1254,97 +1304,168 @@ fn reflow_text_chunk(
             out.extend_from_slice(&chunk[..lead_len]); // leading spaces (no newlines here)
             out.push(b'\n');
             out.extend_from_slice(&body[1..indent_end]); // indentation
-            let rest = std::str::from_utf8(&body[indent_end..]).unwrap();
-            let reflowed = reflow_text(rest, use_markdown);
-            out.extend_from_slice(reflowed.as_bytes());
+            let rest = &body[indent_end..];
+            reflow_text(rest, use_markdown, out);
             out.extend_from_slice(&chunk[chunk.len() - trail_len..]);
             return;
         }
     }
 
     // Soft-wrap at start-of-body — but NOT if that newline introduces a DT/DD line.
-    let mut tmp = String::new();
+    let mut tmp = Vec::new();
     let body_str = if body.starts_with(b"\n") && (body.len() == 1 || body[1] != b'\n')
-        && !prev_line_ends_with_structural_start(src, at_index_i)
         && !after_br && !after_boundary
         && !(use_markdown && body_begins_with_dt_or_dd_after_single_lf(body))
+        && !prev_line_ends_with_structural_start(src, lines, at_index_i)
     {
         let mut j = 1usize;
         while j < body.len() && (body[j] == b' ' || body[j] == b'\t') { j += 1; }
-        let rest = std::str::from_utf8(&body[j..]).unwrap();
-        tmp.push(' ');
-        tmp.push_str(rest);
+        tmp.push(b' ');
+        tmp.extend_from_slice(&body[j..]);
         &tmp
     } else {
-        std::str::from_utf8(body).unwrap()
+        body
     };
 
-    let mut reflowed = reflow_text(body_str, use_markdown);
+    out.extend_from_slice(&chunk[..lead_len]); // leading spaces
+    let reflow_start = out.len();
+    reflow_text(body_str, use_markdown, out);
 
     // If this chunk ends with exactly one LF (ignoring spaces) and next token is inline-start,
     // collapse that single LF (+ indent) to a single space (unless prev line ended with structural start).
     let trailing_lfs = trailing_lf_count_ignoring_spaces(chunk);
     if let Some(ti) = ahead_tag {
-        if !ti.is_end && is_inline(ti.name) && trailing_lfs == 1
-            && !prev_line_ends_with_structural_start(src, at_index_i + chunk.len())
+        if !ti.is_end && ahead_category & INLINE != 0 && trailing_lfs == 1
+            && !prev_line_ends_with_structural_start(src, lines, at_index_i + chunk.len())
         {
-            while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            if reflowed.ends_with('\n') {
-                reflowed.pop();
-                while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            }
-            out.extend_from_slice(&chunk[..lead_len]); // leading spaces
-            out.extend_from_slice(reflowed.as_bytes());
+            trim_trailing_soft_break(out, reflow_start);
             out.push(b' ');
             return;
         }
     } else if ahead_is_inline_comment {
-        if trailing_lfs == 1 && !prev_line_ends_with_structural_start(src, at_index_i + chunk.len()) {
-            while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            if reflowed.ends_with('\n') {
-                reflowed.pop();
-                while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            }
-            out.extend_from_slice(&chunk[..lead_len]);
-            out.extend_from_slice(reflowed.as_bytes());
+        if trailing_lfs == 1 && !prev_line_ends_with_structural_start(src, lines, at_index_i + chunk.len()) {
+            trim_trailing_soft_break(out, reflow_start);
             out.push(b' ');
             return;
         }
     } else if ahead_tag.is_none() && !ahead_is_standalone_comment {
-        if trailing_lfs == 1 && !prev_line_ends_with_structural_start(src, at_index_i + chunk.len()) {
-            while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            if reflowed.ends_with('\n') {
-                reflowed.pop();
-                while reflowed.ends_with(' ') || reflowed.ends_with('\t') { reflowed.pop(); }
-            }
-            out.extend_from_slice(&chunk[..lead_len]);
-            out.extend_from_slice(reflowed.as_bytes());
+        if trailing_lfs == 1 && !prev_line_ends_with_structural_start(src, lines, at_index_i + chunk.len()) {
+            trim_trailing_soft_break(out, reflow_start);
             return;
         }
     }
 
-    out.extend_from_slice(&chunk[..lead_len]);
-    out.extend_from_slice(reflowed.as_bytes());
     out.extend_from_slice(&chunk[chunk.len() - trail_len..]);
 }
 
+/* ============================== Tokenizer =============================== */
+
+/// A top-level lexical unit starting at some index `i`.
+#[derive(Clone, Copy, Debug)]
+enum Token {
+    /// `<!-- ... -->`; `end` is the index of the first '-' of the terminator.
+    Comment { end: usize, standalone: bool },
+    /// `<...>`; `end` is the index of the closing '>'.
+    Tag { end: usize },
+    /// Text up to (excluding) the next '<', or EOF.
+    Text { end: usize },
+    /// Unterminated comment or tag: the rest of the input is copied verbatim.
+    Unterminated,
+}
+
+/// Classify the token starting at `i` (< src.len()) in a single scan.
+fn next_token(src: &[u8], i: usize) -> Token {
+    if src[i] != b'<' {
+        let end = memchr(b'<', &src[i..]).map(|off| i + off).unwrap_or(src.len());
+        return Token::Text { end };
+    }
+    if src[i..].starts_with(b"<!--") {
+        let (end, standalone) = scan_comment(src, i);
+        if end == usize::MAX {
+            return Token::Unterminated;
+        }
+        return Token::Comment { end, standalone };
+    }
+    match find_tag_end(src, i) {
+        Some(end) => Token::Tag { end },
+        None => Token::Unterminated,
+    }
+}
+
 /* ============================== Transform =============================== */
 
+/// An open element; `name` borrows the source bytes in their original case.
 #[derive(Clone)]
-struct OpenElement {
-    name: Vec<u8>,
+struct OpenElement<'a> {
+    name: &'a [u8],
     has_noreformat: bool,
 }
 
-fn transform(src: &[u8], out: &mut Vec<u8>, use_markdown: bool) {
+/// Stack of open elements that also counts its `data-noreformat` entries, so
+/// "are we inside a verbatim subtree?" does not need to walk the stack.
+#[derive(Default)]
+struct OpenStack<'a> {
+    elements: Vec<OpenElement<'a>>,
+    noreformat_count: usize,
+}
+
+impl<'a> OpenStack<'a> {
+    fn push(&mut self, e: OpenElement<'a>) {
+        if e.has_noreformat {
+            self.noreformat_count += 1;
+        }
+        self.elements.push(e);
+    }
+
+    fn pop(&mut self) {
+        if let Some(e) = self.elements.pop() {
+            if e.has_noreformat {
+                self.noreformat_count -= 1;
+            }
+        }
+    }
+
+    fn last(&self) -> Option<&OpenElement<'a>> {
+        self.elements.last()
+    }
+
+    #[inline]
+    fn in_noreformat(&self) -> bool {
+        self.noreformat_count > 0
+    }
+}
+
+/// Output is staged in a buffer and handed to the sink whenever it grows past
+/// this size, at a token boundary (nothing reads back across tokens).
+const FLUSH_THRESHOLD: usize = 64 * 1024;
+
+fn transform<W: Write>(src: &[u8], sink: &mut W, use_markdown: bool) -> io::Result<()> {
+    let mut buf = Vec::with_capacity(src.len().min(FLUSH_THRESHOLD) + 4096);
+    transform_into(src, &mut buf, use_markdown, Some((sink, FLUSH_THRESHOLD)))
+}
+
+/// Run the transform, appending to `out`. With a sink, `out` is flushed to it
+/// whenever it reaches the given size and left empty at the end; without one,
+/// the whole result is accumulated in `out` (which the caller can size up front).
+fn transform_into(
+    src: &[u8],
+    out: &mut Vec<u8>,
+    use_markdown: bool,
+    mut sink: Option<(&mut dyn Write, usize)>,
+) -> io::Result<()> {
     let mut i = 0usize;
     let n = src.len();
 
     // Stacks/state
-    let mut raw_stack: Vec<Vec<u8>> = Vec::new();        // names of raw-text tags in lowercase
-    let mut open_stack: Vec<OpenElement> = Vec::new();
+    // Open raw-text element, if any. Its content is copied verbatim up to the
+    // matching end tag, so raw-text elements never nest.
+    let mut raw_open: Option<&[u8]> = None;
+    let mut open_stack = OpenStack::default();
     let mut after_boundary = false;
     let mut after_br = false;
+    let lines = LineIndex::new(src);
+    // Token at the end of the last text chunk, already scanned by its lookahead.
+    let mut ahead: Option<(usize, Lookahead)> = None;
 
     let p_closing: &[&[u8]] = &[
         b"address", b"article", b"aside", b"blockquote", b"center", b"details", b"dialog", b"dir",
@@ -1353,150 +1474,154 @@ fn transform(src: &[u8], out: &mut Vec<u8>, use_markdown: bool) {
     ];
 
     while i < n {
+        if let Some((sink, flush_at)) = sink.as_mut() {
+            if out.len() >= *flush_at {
+                sink.write_all(out)?;
+                out.clear();
+            }
+        }
+
         // If inside a RAW-TEXT element, copy verbatim until its matching end tag.
-        if let Some(current_raw) = raw_stack.last() {
+        if let Some(current_raw) = raw_open {
             let (new_i, closed) = copy_raw_text_until_end(src, i, current_raw, out);
             i = new_i;
             after_boundary = false;
             after_br = false;
             if closed {
-                raw_stack.pop();
+                raw_open = None;
                 open_stack.pop();
             }
             continue;
         }
 
-        // Comments
-        if src[i..].starts_with(b"<!--") {
-            let (j_end, standalone) = scan_comment(src, i);
-            if j_end == usize::MAX {
+        let (token, scanned_tag) = match ahead.take() {
+            Some((pos, la)) if pos == i => (la.token, la.tag),
+            _ => (next_token(src, i), None),
+        };
+        match token {
+            Token::Unterminated => {
                 out.extend_from_slice(&src[i..]);
-                return;
-            }
-            let seg = &src[i..=j_end + 2]; // includes "-->"
-            let is_verbatim = open_stack.iter().any(|e| e.has_noreformat);
-            if is_verbatim {
-                out.extend_from_slice(seg);
-            } else if standalone {
-                out.extend_from_slice(seg);
-                after_boundary = true;
-            } else {
-                reflow_inline_comment(seg, out);
-                after_boundary = false;
+                break;
             }
-            i = j_end + 3;
-            continue;
-        }
 
-        // Tags
-        if src[i] == b'<' {
-            let Some(j) = find_tag_end(src, i) else {
-                out.extend_from_slice(&src[i..]);
-                return;
-            };
-            let tag = &src[i..=j];
-            let ti = parse_tag_info(tag);
-
-            let has_this_noreformat = tag_has_noreformat_attr(tag);
-            let is_verbatim = open_stack.iter().any(|e| e.has_noreformat) || (!ti.is_end && has_this_noreformat);
-            if is_verbatim {
-                out.extend_from_slice(tag);
-            } else {
-                normalize_inside_tag(tag, out);
+            Token::Comment { end: j_end, standalone } => {
+                let seg = &src[i..=j_end + 2]; // includes "-->"
+                let is_verbatim = open_stack.in_noreformat();
+                if is_verbatim {
+                    out.extend_from_slice(seg);
+                } else if standalone {
+                    out.extend_from_slice(seg);
+                    after_boundary = true;
+                } else {
+                    reflow_inline_comment(seg, out);
+                    after_boundary = false;
+                }
+                i = j_end + 3;
             }
 
-            // open_stack handling
-            let mut name_lower = ti.name.to_vec();
-            name_lower.make_ascii_lowercase();
-            if ti.is_end {
-                while let Some(top) = open_stack.last() {
-                    if top.name == name_lower {
-                        open_stack.pop();
-                        break;
-                    } else {
-                        open_stack.pop();
-                    }
+            Token::Tag { end: j } => {
+                let tag = &src[i..=j];
+                let ti = scanned_tag.unwrap_or_else(|| parse_tag_info(tag));
+                let category = tag_category(ti.name);
+
+                // Only start tags can open a verbatim subtree; end tags skip the attribute scan.
+                let has_this_noreformat = !ti.is_end && tag_has_noreformat_attr(tag, &ti);
+                let is_verbatim = open_stack.in_noreformat() || has_this_noreformat;
+                if is_verbatim {
+                    out.extend_from_slice(tag);
+                } else {
+                    normalize_inside_tag(tag, out);
                 }
-            } else if !ti.self_closing && !is_void(ti.name) {
-                // implied closes
-                if name_lower == b"li" {
-                    if let Some(top) = open_stack.last() {
-                        if top.name == b"li" {
+
+                // open_stack handling (names are compared case-insensitively)
+                if ti.is_end {
+                    while let Some(top) = open_stack.last() {
+                        if top.name.eq_ignore_ascii_case(ti.name) {
                             open_stack.pop();
-                        }
-                    }
-                } else if name_lower == b"dt" || name_lower == b"dd" {
-                    if let Some(top) = open_stack.last() {
-                        if top.name == b"dt" || top.name == b"dd" {
+                            break;
+                        } else {
                             open_stack.pop();
                         }
                     }
-                } else if matches_ignore_ascii_case(&name_lower, p_closing) {
-                    if let Some(top) = open_stack.last() {
-                        if top.name == b"p" {
-                            open_stack.pop();
+                } else if !ti.self_closing && category & VOID == 0 {
+                    // implied closes
+                    if ti.name.eq_ignore_ascii_case(b"li") {
+                        if let Some(top) = open_stack.last() {
+                            if top.name.eq_ignore_ascii_case(b"li") {
+                                open_stack.pop();
+                            }
+                        }
+                    } else if ti.name.eq_ignore_ascii_case(b"dt") || ti.name.eq_ignore_ascii_case(b"dd") {
+                        if let Some(top) = open_stack.last() {
+                            if top.name.eq_ignore_ascii_case(b"dt") || top.name.eq_ignore_ascii_case(b"dd") {
+                                open_stack.pop();
+                            }
+                        }
+                    } else if matches_ignore_ascii_case(ti.name, p_closing) {
+                        if let Some(top) = open_stack.last() {
+                            if top.name.eq_ignore_ascii_case(b"p") {
+                                open_stack.pop();
+                            }
                         }
                     }
+
+                    open_stack.push(OpenElement {
+                        name: ti.name,
+                        has_noreformat: has_this_noreformat,
+                    });
                 }
 
-                open_stack.push(OpenElement {
-                    name: name_lower.clone(),
-                    has_noreformat: has_this_noreformat,
-                });
-            }
+                // raw-text tracking
+                if category & RAW_TEXT != 0 && !ti.is_end && !ti.self_closing {
+                    raw_open = Some(ti.name);
+                }
 
-            // raw-text tracking
-            if is_raw_text(ti.name) && !ti.is_end && !ti.self_closing {
-                raw_stack.push(name_lower.clone());
-            }
+                // <br> rule
+                if !ti.is_end && ti.name.eq_ignore_ascii_case(b"br") {
+                    if j + 1 < n && src[j + 1] == b'\n' {
+                        out.push(b'\n');
+                        i = j + 2;
+                        after_br = true;
+                        continue;
+                    } else {
+                        after_br = true;
+                    }
+                }
 
-            // <br> rule
-            if !ti.is_end && ti.name.eq_ignore_ascii_case(b"br") {
-                if j + 1 < n && src[j + 1] == b'\n' {
-                    out.push(b'\n');
-                    i = j + 2;
-                    after_br = true;
-                    continue;
+                // Set after_boundary for structural start tags
+                if !ti.is_end && category & STRUCTURAL != 0 {
+                    after_boundary = true;
                 } else {
-                    after_br = true;
+                    after_boundary = false;
                 }
-            }
 
-            // Set after_boundary for structural start tags
-            if !ti.is_end && is_structural(&name_lower) {
-                after_boundary = true;
-            } else {
-                after_boundary = false;
+                i = j + 1;
             }
 
-            i = j + 1;
-            continue;
-        }
+            Token::Text { end: next_lt } => {
+                let chunk = &src[i..next_lt];
 
-        // Text run
-        let next_lt = memchr(b'<', &src[i..]).map(|off| i + off).unwrap_or(n);
-        let chunk = &src[i..next_lt];
+                let is_verbatim = open_stack.in_noreformat();
+                if is_verbatim {
+                    out.extend_from_slice(chunk);
+                } else {
+                    let mut ctx = ChunkContext { src, lines: &lines, at_index_i: i, next_lt, ahead: None };
+                    reflow_text_chunk(chunk, &mut ctx, out, use_markdown, after_boundary, after_br);
+                    ahead = ctx.ahead.map(|t| (next_lt, t));
+                }
 
-        let is_verbatim = open_stack.iter().any(|e| e.has_noreformat);
-        if is_verbatim {
-            out.extend_from_slice(chunk);
-        } else {
-            reflow_text_chunk(
-                chunk,
-                src,
-                next_lt,
-                out,
-                use_markdown,
-                after_boundary,
-                after_br,
-                i,
-            );
+                after_boundary = false;
+                after_br = false;
+                i = next_lt;
+            }
         }
+    }
 
-        after_boundary = false;
-        after_br = false;
-        i = next_lt;
+    if let Some((sink, _)) = sink {
+        sink.write_all(out)?;
+        out.clear();
     }
+    Ok(())
 }
 
 #[cfg(test)]
@@ -1533,15 +1658,26 @@ mod tests {
             // Enable markdown for .bs, disable for .html
             let use_markdown = ext == "bs";
 
-            transform(&src, &mut out, use_markdown);
+            transform(&src, &mut out, use_markdown).unwrap();
+
+            // The in-place CLI path accumulates everything without a sink.
+            let mut unflushed = Vec::new();
+            transform_into(&src, &mut unflushed, use_markdown, None).unwrap();
+            assert_eq!(unflushed, out, "Buffered output differs for test: {}", stem);
+
+            // Flushing after every token must not change the output either.
+            let (mut staged, mut flushed) = (Vec::new(), Vec::new());
+            transform_into(&src, &mut staged, use_markdown, Some((&mut flushed, 0))).unwrap();
+            assert_eq!(flushed, out, "Flushed output differs for test: {}", stem);
 
-            let actual = String::from_utf8(out).unwrap();
+            // Plain mode passes bytes through, so the output need not be UTF-8.
+            let actual = out;
 
             if update_expected {
                 fs::create_dir_all(expected_dir).unwrap();
-                fs::write(&expected_path, actual.as_bytes()).unwrap();
+                fs::write(&expected_path, &actual).unwrap();
             } else {
-                let expected = fs::read_to_string(&expected_path).unwrap_or_else(|_| panic!("Expected file not found: {:?}", expected_path));
+                let expected = fs::read(&expected_path).unwrap_or_else(|_| panic!("Expected file not found: {:?}", expected_path));
                 assert_eq!(actual, expected, "Mismatch for test: {}", stem);
             }
         }